@@ -0,0 +1,518 @@
+"""Load test the website and compare with a stored baseline.
+
+Build the website with ``mys build`` and then run this script in the
+tests directory. Store a baseline with ``--save-baseline``. Later runs
+fail if throughput, hot path latency percentiles or memory usage are
+worse than the baseline by more than the tolerance, or if too many
+requests fail.
+
+"""
+
+import io
+import os
+import sys
+import json
+import time
+import random
+import shutil
+import signal
+import socket
+import tarfile
+import threading
+import subprocess
+from argparse import ArgumentParser
+from concurrent.futures import ThreadPoolExecutor
+import requests
+
+GRAPHQL_PACKAGES_QUERY = '''
+{
+  standardLibrary {
+    numberOfPackages
+    numberOfDownloads
+    packages {
+      name
+      numberOfDownloads
+      latestRelease {
+        version
+      }
+    }
+  }
+}
+'''
+
+GRAPHQL_PACKAGE_QUERY = '''
+{
+  standardLibrary {
+    package(name: "%s") {
+      name
+      dependents(transitive: true)
+      dependencies(transitive: true)
+      rebuildOrder
+    }
+  }
+}
+'''
+
+HOT_PATH_KINDS = [
+    'package-docs',
+    'mys-docs',
+    'download',
+    'graphql'
+]
+
+MYS_PAGES = [
+    '/',
+    '/user-guide.html',
+    '/language-reference.html',
+    '/search.html',
+    '/searchindex.js'
+]
+
+
+def read_rss(pid):
+    """Returns resident set size in bytes of given process and its
+    children, which are the workers.
+
+    """
+
+    rss = 0
+
+    try:
+        with open(f'/proc/{pid}/task/{pid}/children') as fin:
+            pids = [pid] + [int(child) for child in fin.read().split()]
+    except OSError:
+        pids = [pid]
+
+    for pid in pids:
+        try:
+            with open(f'/proc/{pid}/status') as fin:
+                for line in fin:
+                    if line.startswith('VmRSS:'):
+                        rss += 1024 * int(line.split()[1])
+        except OSError:
+            pass
+
+    return rss
+
+
+def percentile(sorted_values, fraction):
+    if not sorted_values:
+        return 0.0
+
+    index = min(int(fraction * len(sorted_values)), len(sorted_values) - 1)
+
+    return sorted_values[index]
+
+
+def create_package_archive(template, name, version, dependencies):
+    """Create a package archive from the template archive with given name,
+    version and dependencies.
+
+    """
+
+    data = io.BytesIO()
+
+    with tarfile.open(template) as fin:
+        with tarfile.open(fileobj=data, mode='w:gz') as fout:
+            for member in fin.getmembers():
+                content = fin.extractfile(member) if member.isfile() else None
+                parts = member.name.split('/', 1)
+                parts[0] = f'{name}-{version}'
+                member.name = '/'.join(parts)
+
+                if member.name.endswith('/package.toml'):
+                    config = [
+                        '[package]',
+                        f'name = "{name}"',
+                        f'version = "{version}"',
+                        f'description = "Benchmark package {name}."',
+                        '',
+                        '[dependencies]'
+                    ]
+                    config += [f'{dependency} = "latest"'
+                               for dependency in dependencies]
+                    content = io.BytesIO('\n'.join(config).encode('utf-8') + b'\n')
+                    member.size = len(content.getvalue())
+
+                fout.addfile(member, content)
+
+    return data.getvalue()
+
+
+class Website:
+
+    def __init__(self, app, port, database, workers):
+        self.base_url = f'http://localhost:{port}'
+        shutil.rmtree(database, ignore_errors=True)
+        self.log = open('benchmark-website.log', 'w')
+        self.process = subprocess.Popen([app,
+                                         '--port', str(port),
+                                         '--database-directory', database,
+                                         '--workers', str(workers)],
+                                        stdout=self.log,
+                                        stderr=subprocess.STDOUT)
+        self.wait_for_port(port)
+
+    def wait_for_port(self, port):
+        """The website's output is buffered when not written to a
+        terminal, so wait for it to accept clients instead of waiting for
+        it to print that it is listening.
+
+        """
+
+        end_time = time.time() + 30
+
+        while time.time() < end_time:
+            if self.process.poll() is not None:
+                sys.exit('Website exited, see benchmark-website.log.')
+
+            try:
+                socket.create_connection(('localhost', port)).close()
+
+                return
+            except OSError:
+                time.sleep(0.1)
+
+        self.stop()
+        sys.exit('Website did not start, see benchmark-website.log.')
+
+    def stop(self):
+        self.process.send_signal(signal.SIGINT)
+        self.process.wait()
+        self.log.close()
+
+
+class Benchmark:
+
+    def __init__(self, website, number_of_packages, seed):
+        self.website = website
+        self.number_of_packages = number_of_packages
+        self.random = random.Random(seed)
+        self.tokens = {}
+        self.versions = {}
+        self.dependencies = {}
+        self.lock = threading.Lock()
+        self.latencies = {}
+        self.errors = 0
+
+    def url(self, path):
+        return f'{self.website.base_url}{path}'
+
+    def package_name(self, index):
+        return f'bench_{index:04}'
+
+    def upload_package(self, name, version, dependencies):
+        data = create_package_archive('bar-0.3.0.tar.gz',
+                                      name,
+                                      version,
+                                      dependencies)
+        response = requests.post(self.url(f'/package/{name}-{version}.tar.gz'),
+                                 data=data,
+                                 params={'token': self.tokens.get(name)})
+        response.raise_for_status()
+
+        if response.text:
+            self.tokens[name] = response.json()['token']
+
+    def seed(self):
+        """Upload Mys and packages depending on up to three earlier packages.
+
+        """
+
+        with open('mys-0.267.0.tar.gz', 'rb') as fin:
+            response = requests.post(self.url('/mys-0.267.0.tar.gz'),
+                                     data=fin.read())
+            response.raise_for_status()
+
+        for index in range(self.number_of_packages):
+            name = self.package_name(index)
+            dependencies = sorted({
+                self.package_name(self.random.randrange(index))
+                for _ in range(min(index, self.random.randrange(4)))
+            })
+            self.upload_package(name, '0.1.0', dependencies)
+            self.versions[name] = [0, 1, 0]
+            self.dependencies[name] = dependencies
+
+    def random_package(self):
+        return self.package_name(self.random.randrange(self.number_of_packages))
+
+    def get(self, path):
+        return requests.get(self.url(path))
+
+    def do_package_docs(self):
+        return self.get(f'/package/{self.random_package()}/latest/index.html')
+
+    def do_mys_docs(self):
+        return self.get(self.random.choice(MYS_PAGES))
+
+    def do_download(self):
+        return self.get(f'/package/{self.random_package()}-latest.tar.gz')
+
+    def do_standard_library(self):
+        return self.get('/standard-library.html')
+
+    def do_statistics(self):
+        return self.get(self.random.choice(['/statistics.html',
+                                            '/activity.html',
+                                            '/_images/world.svg']))
+
+    def do_graphql(self):
+        if self.random.random() < 0.5:
+            query = GRAPHQL_PACKAGES_QUERY
+        else:
+            query = GRAPHQL_PACKAGE_QUERY % self.random_package()
+
+        return requests.post(self.url('/graphql'), json={'query': query})
+
+    def do_upload(self):
+        name = self.random_package()
+
+        with self.lock:
+            version = self.versions[name]
+            version[2] += 1
+            version = '.'.join(str(part) for part in version)
+
+        # Keep the dependencies to not change the dependency graph
+        # during the run.
+        self.upload_package(name, version, self.dependencies[name])
+
+    def choose_operation(self):
+        return self.random.choices(
+            [
+                ('package-docs', self.do_package_docs),
+                ('mys-docs', self.do_mys_docs),
+                ('download', self.do_download),
+                ('standard-library', self.do_standard_library),
+                ('statistics', self.do_statistics),
+                ('graphql', self.do_graphql),
+                ('upload', self.do_upload)
+            ],
+            weights=[30, 10, 20, 10, 5, 20, 5])[0]
+
+    def client(self, end_time):
+        while time.time() < end_time:
+            with self.lock:
+                kind, operation = self.choose_operation()
+
+            start_time = time.time()
+
+            try:
+                response = operation()
+                ok = (response is None or response.status_code == 200)
+            except Exception:
+                ok = False
+
+            latency = time.time() - start_time
+
+            with self.lock:
+                if ok:
+                    self.latencies.setdefault(kind, []).append(latency)
+                else:
+                    self.errors += 1
+
+    def run(self, duration, concurrency):
+        end_time = time.time() + duration
+        max_rss = 0
+
+        with ThreadPoolExecutor(concurrency) as executor:
+            futures = [
+                executor.submit(self.client, end_time)
+                for _ in range(concurrency)
+            ]
+
+            while time.time() < end_time:
+                max_rss = max(max_rss, read_rss(self.website.process.pid))
+                time.sleep(0.5)
+
+            for future in futures:
+                future.result()
+
+        return self.create_report(duration, max_rss)
+
+    def create_report(self, duration, max_rss):
+        kinds = {}
+        number_of_requests = 0
+
+        for kind, latencies in sorted(self.latencies.items()):
+            latencies.sort()
+            number_of_requests += len(latencies)
+            kinds[kind] = {
+                'count': len(latencies),
+                'p50': percentile(latencies, 0.50),
+                'p95': percentile(latencies, 0.95),
+                'p99': percentile(latencies, 0.99)
+            }
+
+        return {
+            'throughput': number_of_requests / duration,
+            'errors': self.errors,
+            'max-rss': max_rss,
+            'kinds': kinds
+        }
+
+
+def print_report(report):
+    print(f'Throughput: {report["throughput"]:.1f} requests/s')
+    print(f'Errors:     {report["errors"]}')
+    print(f'Max RSS:    {report["max-rss"] / 1024 / 1024:.1f} MB')
+    print()
+    print(f'{"Kind":<20}{"Count":>8}{"p50 ms":>10}{"p95 ms":>10}{"p99 ms":>10}')
+
+    for kind, data in report['kinds'].items():
+        print(f'{kind:<20}{data["count"]:>8}'
+              f'{1000 * data["p50"]:>10.1f}'
+              f'{1000 * data["p95"]:>10.1f}'
+              f'{1000 * data["p99"]:>10.1f}')
+
+
+def get_error_rate(report):
+    number_of_requests = sum(data['count'] for data in report['kinds'].values())
+    number_of_requests += report['errors']
+
+    if number_of_requests == 0:
+        return 0.0
+
+    return report['errors'] / number_of_requests
+
+
+def compare_with_baseline(report, baseline, tolerance, p99_tolerance, max_error_rate):
+    """Returns a list of regressions compared to given baseline. Only
+    latencies of hot path request kinds are compared, as the others are
+    too few or too noisy. p99 varies more than p50 and p95, and has a
+    tolerance of its own.
+
+    """
+
+    regressions = []
+
+    if report['throughput'] < (1 - tolerance) * baseline['throughput']:
+        regressions.append(f'Throughput {report["throughput"]:.1f} requests/s, '
+                           f'baseline {baseline["throughput"]:.1f}.')
+
+    if report['max-rss'] > (1 + tolerance) * baseline['max-rss']:
+        regressions.append(f'Max RSS {report["max-rss"]} bytes, '
+                           f'baseline {baseline["max-rss"]}.')
+
+    error_rate = get_error_rate(report)
+
+    if error_rate > max_error_rate:
+        regressions.append(f'Error rate {100 * error_rate:.2f}%, '
+                           f'maximum {100 * max_error_rate:.2f}%.')
+
+    for kind in HOT_PATH_KINDS:
+        if kind not in report['kinds'] or kind not in baseline['kinds']:
+            continue
+
+        for name, allowed in [('p50', tolerance),
+                              ('p95', tolerance),
+                              ('p99', p99_tolerance)]:
+            value = report['kinds'][kind][name]
+            expected = baseline['kinds'][kind][name]
+
+            if value > (1 + allowed) * expected:
+                regressions.append(
+                    f'{kind} {name} {1000 * value:.1f} ms, '
+                    f'baseline {1000 * expected:.1f} ms.')
+
+    return regressions
+
+
+def main():
+    parser = ArgumentParser(description=__doc__)
+    parser.add_argument('--app',
+                        default='../build/speed/app',
+                        help='Website executable (default: %(default)s).')
+    parser.add_argument('--port', type=int, default=18001)
+    parser.add_argument('--workers',
+                        type=int,
+                        default=1,
+                        help='Number of website workers (default: %(default)s).')
+    parser.add_argument('--packages',
+                        type=int,
+                        default=300,
+                        help='Number of packages to create (default: %(default)s).')
+    parser.add_argument('--duration',
+                        type=float,
+                        default=30,
+                        help='Load duration in seconds (default: %(default)s).')
+    parser.add_argument('--concurrency',
+                        type=int,
+                        default=16,
+                        help='Number of concurrent clients (default: %(default)s).')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--baseline',
+                        default='benchmark-baseline.json',
+                        help='Baseline file (default: %(default)s).')
+    parser.add_argument('--save-baseline',
+                        action='store_true',
+                        help='Save the results as baseline instead of comparing.')
+    parser.add_argument('--require-baseline',
+                        action='store_true',
+                        help='Fail if there is no baseline to compare with.')
+    parser.add_argument(
+        '--tolerance',
+        type=float,
+        default=0.2,
+        help=('Allowed relative regression of throughput, memory usage, p50 '
+              'and p95 (default: %(default)s).'))
+    parser.add_argument(
+        '--p99-tolerance',
+        type=float,
+        default=0.5,
+        help='Allowed relative regression of p99 (default: %(default)s).')
+    parser.add_argument(
+        '--max-error-rate',
+        type=float,
+        default=0.01,
+        help='Allowed fraction of failed requests (default: %(default)s).')
+    args = parser.parse_args()
+
+    website = Website(args.app, args.port, 'storage-benchmark', args.workers)
+
+    try:
+        benchmark = Benchmark(website, args.packages, args.seed)
+        print(f'Seeding the database with {args.packages} packages.')
+        benchmark.seed()
+        print(f'Running {args.concurrency} clients for {args.duration} seconds.')
+        report = benchmark.run(args.duration, args.concurrency)
+    finally:
+        website.stop()
+
+    print_report(report)
+
+    if args.save_baseline:
+        with open(args.baseline, 'w') as fout:
+            json.dump(report, fout, indent=4)
+
+        print(f'Baseline saved in {args.baseline}.')
+    elif os.path.exists(args.baseline):
+        with open(args.baseline) as fin:
+            baseline = json.load(fin)
+
+        regressions = compare_with_baseline(report,
+                                            baseline,
+                                            args.tolerance,
+                                            args.p99_tolerance,
+                                            args.max_error_rate)
+
+        if regressions:
+            print()
+            print('Regressions:')
+
+            for regression in regressions:
+                print(f'  {regression}')
+
+            sys.exit(1)
+
+        print()
+        print('No regressions.')
+    else:
+        print(f'No baseline {args.baseline} found.')
+
+        if args.require_baseline:
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
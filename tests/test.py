@@ -1,6 +1,11 @@
+import io
 import os
 import sys
+import time
+import socket
 import shutil
+import sqlite3
+import tarfile
 import pexpect
 import requests
 import subprocess
@@ -17,6 +22,11 @@ LOGGER = logging.getLogger(__name__)
 
 PORT = 18000
 BASE_URL = f'http://localhost:{PORT}'
+WORKERS_PORT = 18001
+WORKERS_BASE_URL = f'http://localhost:{WORKERS_PORT}'
+LIMITS_PORT = 18002
+LIMITS_BASE_URL = f'http://localhost:{LIMITS_PORT}'
+NUMBER_OF_CLIENT_HANDLERS = 20
 
 
 class WebsiteReaderThread(threading.Thread):
@@ -59,14 +69,25 @@ class Logger:
 
 class TestCase(systest.TestCase):
 
-    def http_get(self, path):
-        return requests.get(f"{BASE_URL}{path}")
+    base_url = BASE_URL
+
+    def http_get(self, path, params=None, headers=None):
+        return requests.get(f"{self.base_url}{path}", params=params, headers=headers)
 
     def http_post(self, path, data=None, params=None, json=None):
-        return requests.post(f"{BASE_URL}{path}", data=data, params=params, json=json)
+        return requests.post(f"{self.base_url}{path}",
+                             data=data,
+                             params=params,
+                             json=json)
 
     def http_delete(self, path, params=None):
-        return requests.delete(f"{BASE_URL}{path}", params=params)
+        return requests.delete(f"{self.base_url}{path}", params=params)
+
+    def graphql_query(self, query):
+        response = self.http_post("/graphql", json={'query': query})
+        self.assert_equal(response.status_code, 200)
+
+        return response.json()['data']
 
     def subprocess_run(self, command):
         return subprocess.run(command, check=True, capture_output=True, text=True)
@@ -311,20 +332,91 @@ class UpdateBuildResultsTest(TestCase):
 
     """
 
-    def run(self):
-        shutil.rmtree('stdall', ignore_errors=True)
-        self.subprocess_run([
+    def update(self):
+        return self.subprocess_run([
             sys.executable,
             'update_standard_library_build_results.py',
-            '--url', BASE_URL
+            '--url', BASE_URL,
+            '--state-file', 'build-state.json',
+            '--parallel', '2'
         ])
 
+    def run(self):
+        shutil.rmtree('stdall', ignore_errors=True)
+
+        if os.path.exists('build-state.json'):
+            os.remove('build-state.json')
+
+        proc = self.update()
+        self.assert_not_in('foo: Unchanged, skipping.', proc.stdout)
+
         response = self.http_get("/standard-library/foo/build-log.html")
         self.assert_equal(response.status_code, 200)
         text = response.text
         self.assert_equal(text.count('Reading package configuration'), 2)
         self.assert_equal(text.count('Building'), 2)
 
+        # Nothing has changed, so nothing is built.
+        proc = self.update()
+        self.assert_in('foo: Unchanged, skipping.', proc.stdout)
+
+
+class BuildResultsTest(TestCase):
+    """Upload build results of many packages at once.
+
+    """
+
+    def create_archive(self, results, files):
+        data = io.BytesIO()
+
+        with tarfile.open(fileobj=data, mode='w:gz') as tar:
+            files = dict(files)
+            files['results.txt'] = results
+
+            for name, content in files.items():
+                info = tarfile.TarInfo(name)
+                info.size = len(content)
+                tar.addfile(info, io.BytesIO(content))
+
+        return data.getvalue()
+
+    def run(self):
+        data = self.create_archive(
+            b'foo yes\n',
+            {
+                'foo/build-log.html': b'<html>The batch log!</html>',
+                'foo/coverage/html/index.html': b'<html>Coverage!</html>'
+            })
+        response = self.http_post("/standard-library/build-results.tar.gz", data)
+        self.assert_equal(response.status_code, 200)
+
+        response = self.http_get("/standard-library/foo/build-log.html")
+        self.assert_equal(response.status_code, 200)
+        self.assert_equal(response.content, b'<html>The batch log!</html>')
+
+        response = self.http_get("/standard-library/foo/coverage/html/index.html")
+        self.assert_equal(response.status_code, 200)
+        self.assert_equal(response.content, b'<html>Coverage!</html>')
+
+        response = self.http_get("/standard-library.html")
+        self.assert_equal(response.status_code, 200)
+        self.assert_in('✅', response.content.decode('utf-8'))
+
+        # Unknown package.
+        data = self.create_archive(b'foo no\nnonexisting yes\n', {})
+        response = self.http_post("/standard-library/build-results.tar.gz", data)
+        self.assert_equal(response.status_code, 404)
+
+        # Bad result.
+        data = self.create_archive(b'foo maybe\n', {})
+        response = self.http_post("/standard-library/build-results.tar.gz", data)
+        self.assert_equal(response.status_code, 400)
+
+        # Nothing changed by the failed uploads.
+        response = self.http_get("/standard-library.html")
+        self.assert_equal(response.status_code, 200)
+        self.assert_in('✅', response.content.decode('utf-8'))
+
 
 class PackageNoDocTest(TestCase):
 
@@ -386,6 +478,16 @@ class PackageDependentsTest(TestCase):
         self.assert_equal(response.text, "deps_a\n")
         response = self.http_get("/standard-library/deps_d/dependents.txt")
         self.assert_equal(response.status_code, 404)
+        response = self.http_get("/standard-library/deps_b/dependents.txt",
+                                 params={'transitive': 'true'})
+        self.assert_equal(response.status_code, 200)
+        self.assert_equal(response.text, "deps_a\n")
+        response = self.http_get("/standard-library/deps_a/dependencies.txt")
+        self.assert_equal(response.status_code, 200)
+        self.assert_equal(response.text, "deps_b\ndeps_c\n")
+        response = self.http_get("/standard-library/deps_b/rebuild-order.txt")
+        self.assert_equal(response.status_code, 200)
+        self.assert_equal(response.text, "deps_b\ndeps_a\n")
 
 
 class PackageListTest(TestCase):
@@ -443,6 +545,9 @@ class GraphQLTest(TestCase):
                 "      }"
                 "      name"
                 "      numberOfDownloads"
+                "      dependents(transitive: true)"
+                "      dependencies"
+                "      rebuildOrder"
                 "      linesOfCode {"
                 "        languages {"
                 "          name"
@@ -474,6 +579,9 @@ class GraphQLTest(TestCase):
                 "  }"
                 "  statistics {"
                 "    noIdleClientHandlers"
+                "    numberOfRequestTimeouts"
+                "    numberOfTooManyRequests"
+                "    numberOfTooLargeHeaders"
                 "    numberOfGraphqlRequests"
                 "    numberOfUniqueVisitors"
                 "    startDateTime"
@@ -498,6 +606,9 @@ class GraphQLTest(TestCase):
         package = result['standardLibrary']['package']
         self.assert_equal(package['name'], 'graphql_b')
         self.assert_equal(package['latestRelease']['version'], '0.1.0')
+        self.assert_equal(package['dependents'], [])
+        self.assert_equal(package['dependencies'], [])
+        self.assert_equal(package['rebuildOrder'], ['graphql_b'])
         languages = package['linesOfCode']['languages']
         self.assert_greater_equal(languages[0]['data']['files'], 1)
         self.assert_greater_equal(languages[0]['data']['blank'], 1)
@@ -515,6 +626,9 @@ class GraphQLTest(TestCase):
         self.assert_equal(statistics['numberOfUniqueVisitors'], 0)
         self.assert_equal(statistics['numberOfGraphqlRequests'], 2)
         self.assert_equal(statistics['noIdleClientHandlers'], 0)
+        self.assert_equal(statistics['numberOfRequestTimeouts'], 0)
+        self.assert_equal(statistics['numberOfTooManyRequests'], 0)
+        self.assert_equal(statistics['numberOfTooLargeHeaders'], 0)
 
         activities = result['activities']
         self.assert_in('date', activities[0])
@@ -554,34 +668,220 @@ class ResponseContentTypeJsTest(TestCase):
         self.assert_equal(response.headers['content-type'], 'application/javascript')
 
 
+class WorkersTest(TestCase):
+    """Statistics and activities are shared between workers, whichever
+    worker serves the request.
+
+    """
+
+    base_url = WORKERS_BASE_URL
+
+    def run(self):
+        with open('mys-0.267.0.tar.gz', 'rb') as fin:
+            response = self.http_post("/mys-0.267.0.tar.gz", fin.read())
+            self.assert_equal(response.status_code, 200)
+
+        for i in range(20):
+            response = self.http_get("/",
+                                     headers={'X-Forwarded-For': f'1.2.3.{i % 3}'})
+            self.assert_equal(response.status_code, 200)
+
+        # Wait for all workers to save and then read each other's
+        # statistics, which may take two sync intervals.
+        time.sleep(11)
+
+        for _ in range(10):
+            data = self.graphql_query('{'
+                                      '  statistics {'
+                                      '    totalNumberOfRequests'
+                                      '    numberOfUniqueVisitors'
+                                      '  }'
+                                      '  activities {'
+                                      '    message'
+                                      '  }'
+                                      '}')
+            statistics = data['statistics']
+            self.assert_equal(statistics['totalNumberOfRequests'], 20)
+            self.assert_equal(statistics['numberOfUniqueVisitors'], 3)
+            messages = [activity['message'] for activity in data['activities']]
+            self.assert_equal(messages.count('Website started.'), 1)
+            self.assert_equal(messages.count('10 requests served.'), 1)
+
+
+class LimitsTestCase(TestCase):
+
+    base_url = LIMITS_BASE_URL
+
+    def connect(self, header):
+        client = socket.create_connection(('localhost', LIMITS_PORT))
+        client.sendall(header)
+
+        return client
+
+    def assert_request_timeout(self, client):
+        client.settimeout(10)
+        self.assert_equal(client.recv(1024), b'HTTP/1.1 408 Request Timeout\r\n\r\n')
+        self.assert_equal(client.recv(1024), b'')
+        client.close()
+
+    def get_statistics(self):
+        return self.graphql_query('{'
+                                  '  statistics {'
+                                  '    numberOfRequestTimeouts'
+                                  '    numberOfTooManyRequests'
+                                  '    numberOfTooLargeHeaders'
+                                  '  }'
+                                  '}')['statistics']
+
+
+class TooLargeHeaderTest(LimitsTestCase):
+    """Headers larger than --max-header-size are rejected.
+
+    """
+
+    def run(self):
+        response = self.http_get("/", headers={'X-Large': 1024 * 'a'})
+        self.assert_equal(response.status_code, 431)
+        self.assert_equal(self.get_statistics()['numberOfTooLargeHeaders'], 1)
+
+
+class RequestTimeoutTest(LimitsTestCase):
+    """Clients stalling in the header are disconnected by the watchdog, and
+    their handlers are freed to serve other clients.
+
+    """
+
+    def run(self):
+        # Occupy all client handlers.
+        clients = [
+            self.connect(b'GET / HTTP/1.1\r\n')
+            for _ in range(NUMBER_OF_CLIENT_HANDLERS)
+        ]
+
+        for client in clients:
+            self.assert_request_timeout(client)
+
+        response = requests.get(f'{self.base_url}/', timeout=5)
+        self.assert_equal(response.status_code, 404)
+        self.assert_equal(self.get_statistics()['numberOfRequestTimeouts'],
+                          NUMBER_OF_CLIENT_HANDLERS)
+
+
+class TooManyRequestsTest(LimitsTestCase):
+    """Clients with more than --max-connections-per-ip concurrent requests
+    are rejected.
+
+    """
+
+    def run(self):
+        header = (b'POST /graphql HTTP/1.1\r\n'
+                  b'X-Forwarded-For: 1.2.3.4\r\n'
+                  b'Content-Length: 100\r\n'
+                  b'\r\n')
+        clients = [self.connect(header) for _ in range(2)]
+        time.sleep(0.5)
+
+        response = requests.post(f'{self.base_url}/graphql',
+                                 json={'query': '{ activities { kind } }'},
+                                 headers={'X-Forwarded-For': '1.2.3.4'})
+        self.assert_equal(response.status_code, 429)
+
+        # Another IP address is not limited.
+        response = requests.post(f'{self.base_url}/graphql',
+                                 json={'query': '{ activities { kind } }'},
+                                 headers={'X-Forwarded-For': '5.6.7.8'})
+        self.assert_equal(response.status_code, 200)
+
+        # The IP address is accepted again once its requests are done.
+        for client in clients:
+            self.assert_request_timeout(client)
+
+        response = requests.post(f'{self.base_url}/graphql',
+                                 json={'query': '{ activities { kind } }'},
+                                 headers={'X-Forwarded-For': '1.2.3.4'})
+        self.assert_equal(response.status_code, 200)
+
+        statistics = self.get_statistics()
+        self.assert_equal(statistics['numberOfTooManyRequests'], 1)
+        self.assert_equal(statistics['numberOfRequestTimeouts'],
+                          NUMBER_OF_CLIENT_HANDLERS + 2)
+
+
+def start_website(port, database_directory, options=''):
+    shutil.rmtree(database_directory, ignore_errors=True)
+    website = pexpect.spawn(
+        f'../build/speed-coverage/app --port {port} -d {database_directory} '
+        f'{options}',
+        logfile=Logger(),
+        encoding='utf-8',
+        codec_errors='replace')
+    website.expect_exact(f"Listening for clients on port {port}.")
+    website_reader_thread = WebsiteReaderThread(website)
+    website_reader_thread.start()
+
+    return website
+
+
+def stop_website(website):
+    website.sendintr()
+    website.wait()
+
+
+def count_activities(database_directory, message):
+    with sqlite3.connect(f'{database_directory}/website.sqlite') as database:
+        cursor = database.execute('SELECT COUNT(*) FROM activities WHERE message == ?',
+                                  (message, ))
+
+        return cursor.fetchone()[0]
+
+
+class WorkersStoppedTest(TestCase):
+    """Only one worker adds the stopped activity.
+
+    """
+
+    def run(self):
+        self.assert_equal(count_activities('storage-workers', 'Website stopped.'), 1)
+
+
 def main():
     sequencer = systest.setup("Mys website",
                               console_log_level=logging.DEBUG)
 
-    shutil.rmtree('storage', ignore_errors=True)
-    website = pexpect.spawn(f'../build/speed-coverage/app --port {PORT} -d storage',
-                            logfile=Logger(),
-                            encoding='utf-8',
-                            codec_errors='replace')
-    website.expect_exact(f"Listening for clients on port {PORT}.")
-    website_reader_thread = WebsiteReaderThread(website)
-    website_reader_thread.start()
+    website = start_website(PORT, 'storage')
+    workers_website = start_website(WORKERS_PORT, 'storage-workers', '--workers 2')
+    limits_website = start_website(LIMITS_PORT,
+                                   'storage-limits',
+                                   '--header-timeout 2 '
+                                   '--body-timeout 2 '
+                                   '--idle-timeout 2 '
+                                   '--max-header-size 1024 '
+                                   '--max-connections-per-ip 2')
 
     sequencer.run(
         FreshDatabaseTest(),
         MysTest(),
         PackageTest(),
         UpdateBuildResultsTest(),
+        BuildResultsTest(),
         PackageNoDocTest(),
         StatisticsTest(),
         ResponseContentTypeJsTest(),
         PackageDependentsTest(),
         PackageListTest(),
-        GraphQLTest()
+        GraphQLTest(),
+        WorkersTest(),
+        TooLargeHeaderTest(),
+        RequestTimeoutTest(),
+        TooManyRequestsTest()
     )
 
-    website.sendintr()
-    website.wait()
+    stop_website(website)
+    stop_website(workers_website)
+    stop_website(limits_website)
+    # Give the other worker some time to exit.
+    time.sleep(1)
+    sequencer.run(WorkersStoppedTest())
     sequencer.report_and_exit()
 
 
@@ -1,33 +1,146 @@
+import io
 import os
 import glob
+import json
 import tempfile
 import shutil
 import subprocess
 import platform
 import tarfile
 import time
+import multiprocessing
 from argparse import ArgumentParser
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures import as_completed
 import requests
-import html5lib
 from ansi2html import Ansi2HTMLConverter
 from xdg import xdg_cache_home
 
 
+PACKAGES_QUERY = '''
+{
+  standardLibrary {
+    packages {
+      name
+      latestRelease {
+        version
+      }
+      dependencies(transitive: true)
+    }
+  }
+}
+'''
+
+MAXIMUM_BUILD_RESULTS_SIZE = 50_000_000
+
+
 def list_all_packages(url):
-    response = requests.get(f'{url}/standard-library.html')
+    """Returns a dictionary of package name to latest version and
+    transitive dependencies.
+
+    """
+
+    response = requests.post(f'{url}/graphql', json={'query': PACKAGES_QUERY})
     response.raise_for_status()
-    document = html5lib.parse(response.text)
-    NS = {'ns': 'http://www.w3.org/1999/xhtml'}
-    packages = []
+    packages = {}
 
-    for row in document.findall('.//ns:table/ns:tbody/ns:tr', NS):
-        packages.append(row[0][0].text)
+    for package in response.json()['data']['standardLibrary']['packages']:
+        packages[package['name']] = {
+            'version': package['latestRelease']['version'],
+            'dependencies': package['dependencies']
+        }
 
     return packages
 
 
+def get_mys_version():
+    return subprocess.run(['mys', '--version'],
+                          text=True,
+                          capture_output=True).stdout.strip()
+
+
+def load_state(path):
+    try:
+        with open(path) as fin:
+            return json.load(fin)
+    except (FileNotFoundError, json.JSONDecodeError):
+        return {}
+
+
+def save_state(path, state):
+    with open(path, 'w') as fout:
+        json.dump(state, fout, indent=4, sort_keys=True)
+
+
+def create_build_key(package, packages, mys_version):
+    """The package is only built if its key has changed since the last
+    build. Dependencies not in the standard library have no version.
+
+    """
+
+    versions = []
+
+    for name in [package] + packages[package]['dependencies']:
+        if name in packages:
+            version = packages[name]['version']
+        else:
+            version = None
+
+        versions.append([name, version])
+
+    return [mys_version, versions]
+
+
+def is_cache_valid(state, packages, mys_version):
+    """Downloaded packages in the cache may only be used if no package
+    version has changed since the last run.
+
+    """
+
+    if state.get('mys-version') != mys_version:
+        return False
+
+    versions = {
+        name: package['version']
+        for name, package in packages.items()
+    }
+
+    return state.get('versions') == versions
+
+
+def get_parallel_cache_home(slot):
+    """Packages built in parallel have caches of their own, as
+    concurrent downloads of dependencies into the same cache are not
+    safe.
+
+    """
+
+    return xdg_cache_home() / f'mys-standard-library-build-results/{slot}'
+
+
 def clear_cache():
     shutil.rmtree(xdg_cache_home() / 'mys/downloads', ignore_errors=True)
+    shutil.rmtree(xdg_cache_home() / 'mys-standard-library-build-results',
+                  ignore_errors=True)
+
+
+def init_parallel_build(slots):
+    """Use a cache of its own in this build process.
+
+    """
+
+    os.environ['XDG_CACHE_HOME'] = str(get_parallel_cache_home(slots.get()))
+
+
+def get_jobs_per_build(jobs, parallel):
+    """Share given number of jobs between packages built in parallel.
+
+    """
+
+    if jobs is None:
+        return None
+
+    return max(jobs // parallel, 1)
 
 
 def add_all_packages_to_dependencies(packages):
@@ -49,11 +162,8 @@ def create_log_header(package_root):
         f'Machine:    {uname.machine}',
         f'Processor:  {uname.processor}'
     ]
-    mys_version = subprocess.run(['mys', '--version'],
-                                 text=True,
-                                 capture_output=True).stdout.strip()
     header += [
-        f'MysVersion: {mys_version}'
+        f'MysVersion: {get_mys_version()}'
     ]
     header += [
         f"Configuration:"
@@ -80,7 +190,7 @@ def build_and_test_package(package, url, jobs):
     build_command = ['mys', '-C', package_root, 'build', '--url', url]
 
     if jobs is not None:
-        build_command += ['-j', jobs]
+        build_command += ['-j', str(jobs)]
 
     try:
         proc = subprocess.run(build_command,
@@ -95,7 +205,7 @@ def build_and_test_package(package, url, jobs):
     test_command = ['mys', '-C', package_root, 'test', '-c', '--url', url]
 
     if jobs is not None:
-        test_command += ['-j', jobs]
+        test_command += ['-j', str(jobs)]
 
     try:
         proc = subprocess.run(test_command,
@@ -113,10 +223,7 @@ def build_and_test_package(package, url, jobs):
         result = 'no'
 
     if test_ok:
-        with tarfile.open('coverage.tar.gz', 'w:gz') as tar:
-            tar.add(f'{package_root}/coverage')
-
-        coverage = 'coverage.tar.gz'
+        coverage = f'{package_root}/coverage'
     else:
         coverage = None
 
@@ -142,48 +249,181 @@ def create_html_log(log):
     return log
 
 
-def upload_build_and_test_result(package, result, log, coverage, url):
-    response = requests.post(
-        f'{url}/standard-library/{package}/build-result.txt',
-        data=result)
-    response.raise_for_status()
+def create_build_results_archive(results_directory, results):
+    with open(os.path.join(results_directory, 'results.txt'), 'w') as fout:
+        for package, result in results.items():
+            print(f'{package} {result}', file=fout)
+
+    data = io.BytesIO()
+
+    with tarfile.open(fileobj=data, mode='w:gz') as tar:
+        tar.add(os.path.join(results_directory, 'results.txt'), 'results.txt')
+
+        for package in results:
+            tar.add(os.path.join(results_directory, package), package)
+
+    return data.getvalue()
 
-    response = requests.post(
-        f'{url}/standard-library/{package}/build-log.html',
-        data=create_html_log(log).encode('utf-8'))
+
+def upload_build_results(results_directory, results, url):
+    """Upload results of given packages in one archive. The archive
+    contains results.txt with one package name and result per line,
+    and the build log and coverage of each package in a directory
+    named after it. Archives larger than the website accepts are split
+    in two.
+
+    """
+
+    data = create_build_results_archive(results_directory, results)
+
+    if len(data) > MAXIMUM_BUILD_RESULTS_SIZE and len(results) > 1:
+        packages = list(results)
+        middle = len(packages) // 2
+
+        for part in [packages[:middle], packages[middle:]]:
+            upload_build_results(results_directory,
+                                 {package: results[package] for package in part},
+                                 url)
+
+        return
+
+    response = requests.post(f'{url}/standard-library/build-results.tar.gz',
+                             data=data)
     response.raise_for_status()
 
-    if coverage is not None:
-        with open(coverage, 'rb') as fin:
-            response = requests.post(
-                f'{url}/standard-library/{package}/coverage.tar.gz',
-                data=fin.read())
-            response.raise_for_status()
 
+def build_package(package, url, jobs, results_directory):
+    """Build and test given package and save its build log and coverage
+    in given results directory.
+
+    """
+
+    package_directory = os.path.abspath(os.path.join(results_directory, package))
 
-def build_and_upload_package(package, url, jobs):
     with tempfile.TemporaryDirectory() as tempdir:
         original_dir = os.getcwd()
         os.chdir(tempdir)
 
         try:
             result, log, coverage = build_and_test_package(package, url, jobs)
-            upload_build_and_test_result(package, result, log, coverage, url)
+            os.makedirs(package_directory)
+
+            with open(os.path.join(package_directory, 'build-log.html'), 'w') as fout:
+                fout.write(create_html_log(log))
+
+            if coverage is not None:
+                shutil.copytree(coverage,
+                                os.path.join(package_directory, 'coverage'))
         finally:
             os.chdir(original_dir)
 
+    return result
+
 
 def main():
     parser = ArgumentParser()
     parser.add_argument('-u', '--url', default='https://mys-lang.org')
-    parser.add_argument('-j', '--jobs')
+    parser.add_argument(
+        '-j', '--jobs',
+        type=int,
+        help=('Number of compiler jobs, shared between packages built in '
+              'parallel.'))
+    parser.add_argument(
+        '-p', '--parallel',
+        type=int,
+        default=1,
+        help='Number of packages to build and test in parallel (default: 1).')
+    parser.add_argument(
+        '-b', '--batch-size',
+        type=int,
+        default=10,
+        help='Number of package results to upload at once (default: 10).')
+    parser.add_argument(
+        '-s', '--state-file',
+        default='standard-library-build-state.json',
+        help=('File with results from earlier runs. Unchanged packages are '
+              'not built again (default: %(default)s).'))
     args = parser.parse_args()
 
     packages = list_all_packages(args.url)
-    clear_cache()
+    mys_version = get_mys_version()
+    state = load_state(args.state_file)
+
+    if not is_cache_valid(state, packages, mys_version):
+        clear_cache()
+
+    state['mys-version'] = mys_version
+    state['versions'] = {
+        name: package['version']
+        for name, package in packages.items()
+    }
+    built = state.setdefault('packages', {})
+    keys = {}
 
     for package in packages:
-        build_and_upload_package(package, args.url, args.jobs)
+        key = create_build_key(package, packages, mys_version)
+
+        if built.get(package, {}).get('key') == key:
+            print(f'{package}: Unchanged, skipping.')
+        else:
+            keys[package] = key
+
+    results_directory = tempfile.mkdtemp()
+    results = {}
+
+    def upload():
+        upload_build_results(results_directory, results, args.url)
+
+        # Only uploaded results are saved in the state.
+        for package, result in results.items():
+            built[package] = {
+                'key': keys[package],
+                'result': result
+            }
+            shutil.rmtree(os.path.join(results_directory, package))
+
+        save_state(args.state_file, state)
+        results.clear()
+
+    jobs = get_jobs_per_build(args.jobs, args.parallel)
+
+    if args.parallel > 1:
+        slots = multiprocessing.Queue()
+
+        for slot in range(args.parallel):
+            slots.put(slot)
+
+        initializer = init_parallel_build
+        initargs = (slots, )
+    else:
+        initializer = None
+        initargs = ()
+
+    try:
+        with ProcessPoolExecutor(args.parallel,
+                                 initializer=initializer,
+                                 initargs=initargs) as executor:
+            futures = {
+                executor.submit(build_package,
+                                package,
+                                args.url,
+                                jobs,
+                                results_directory): package
+                for package in keys
+            }
+
+            for future in as_completed(futures):
+                results[futures[future]] = future.result()
+
+                if len(results) == args.batch_size:
+                    upload()
+
+        if results:
+            upload()
+    finally:
+        shutil.rmtree(results_directory)
+
+    save_state(args.state_file, state)
 
 
 if __name__ == '__main__':